@@ -8,6 +8,8 @@ from tools.image_gen import generate_image
 from tools.background_removal import remove_background
 from tools.image_download import download_image_from_url
 from tools.image_scaling import scale_image
+from tools.image_hashing import find_similar
+from tools import profiling, rate_limiting
 from typing import Optional
 import os
 import sys
@@ -77,6 +79,17 @@ async def handle_get_prompt(name: str, arguments: dict[str, str] | None) -> type
     """Get a specific prompt."""
     raise ValueError(f"Unknown prompt: {name}")
 
+# Accepted by every tool to profile just that call, see the profile tool
+PROFILE_OPTION_SCHEMA = {
+    "type": ["boolean", "object"],
+    "description": "Profile this call and append a per-stage timing summary to the result. Pass true for stage timings only, or an object to also enable cProfile and/or tracemalloc (both process-wide and slower)",
+    "properties": {
+        "cprofile": {"type": "boolean", "default": False},
+        "trace_memory": {"type": "boolean", "default": False}
+    },
+    "default": False
+}
+
 @server.list_tools()
 async def handle_list_tools() -> list[types.Tool]:
     """List available tools."""
@@ -123,7 +136,8 @@ async def handle_list_tools() -> list[types.Tool]:
                         "type": "string",
                         "description": "A negative prompt to avoid in the generated image",
                         "default": ""
-                    }
+                    },
+                    "profile": PROFILE_OPTION_SCHEMA
                 },
                 "required": ["prompt"]
             }
@@ -147,7 +161,8 @@ async def handle_list_tools() -> list[types.Tool]:
                         "type": "boolean",
                         "description": "If true, crop the result to a bounding box around the subject",
                         "default": False
-                    }
+                    },
+                    "profile": PROFILE_OPTION_SCHEMA
                 },
                 "required": ["image_url"]
             }
@@ -166,7 +181,18 @@ async def handle_list_tools() -> list[types.Tool]:
                         "type": "string",
                         "description": "Directory to save the downloaded image",
                         "default": "downloads"
-                    }
+                    },
+                    "skip_duplicates": {
+                        "type": "boolean",
+                        "description": "If true, discard the download when it is a near-duplicate of an image already in output_dir",
+                        "default": False
+                    },
+                    "max_distance": {
+                        "type": "integer",
+                        "description": "Maximum perceptual hash distance for an image to count as a near-duplicate",
+                        "default": 4
+                    },
+                    "profile": PROFILE_OPTION_SCHEMA
                 },
                 "required": ["image_url"]
             }
@@ -191,10 +217,90 @@ async def handle_list_tools() -> list[types.Tool]:
                         },
                         "description": "List of [width, height] pairs for desired output sizes",
                         "default": [[32, 32], [128, 128]]
-                    }
+                    },
+                    "skip_duplicates": {
+                        "type": "boolean",
+                        "description": "If true, reuse the scaled versions of a near-duplicate image in the same directory instead of resizing",
+                        "default": False
+                    },
+                    "max_distance": {
+                        "type": "integer",
+                        "description": "Maximum perceptual hash distance for an image to count as a near-duplicate",
+                        "default": 4
+                    },
+                    "profile": PROFILE_OPTION_SCHEMA
                 },
                 "required": ["input_path"]
             }
+        ),
+        types.Tool(
+            name="find_similar",
+            description="Find previously generated images that look similar to a given image, using perceptual hashes and Hamming distance",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "image_path": {
+                        "type": "string",
+                        "description": "Path to the image to compare against"
+                    },
+                    "directory": {
+                        "type": "string",
+                        "description": "Directory of past images to search",
+                        "default": "downloads"
+                    },
+                    "max_distance": {
+                        "type": "integer",
+                        "description": "Maximum Hamming distance between 64-bit hashes (0 = identical, 64 = opposite)",
+                        "default": 10,
+                        "minimum": 0,
+                        "maximum": 64
+                    },
+                    "method": {
+                        "type": "string",
+                        "description": "Perceptual hash to compare with",
+                        "default": "phash",
+                        "enum": ["ahash", "dhash", "phash"]
+                    },
+                    "limit": {
+                        "type": "integer",
+                        "description": "Maximum number of matches to return",
+                        "default": 10,
+                        "minimum": 1
+                    },
+                    "profile": PROFILE_OPTION_SCHEMA
+                },
+                "required": ["image_path"]
+            }
+        ),
+        types.Tool(
+            name="profile",
+            description="Debug tool: profile every tool call for a time window, recording per-stage wall/CPU time and optionally cProfile and tracemalloc stats. Results are written as flamegraph-compatible folded stacks. A single call can also be profiled through its \"profile\" argument.",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "action": {
+                        "type": "string",
+                        "description": "'start' a profiling window, 'stop' it and write the results, or report 'status'",
+                        "enum": ["start", "stop", "status"]
+                    },
+                    "duration_seconds": {
+                        "type": "number",
+                        "description": "How long the window stays open before its results are written automatically",
+                        "default": 60
+                    },
+                    "cprofile": {
+                        "type": "boolean",
+                        "description": "Also collect cProfile function stats (.prof) for the event loop thread",
+                        "default": True
+                    },
+                    "trace_memory": {
+                        "type": "boolean",
+                        "description": "Record per-stage allocations with tracemalloc (adds noticeable overhead)",
+                        "default": False
+                    }
+                },
+                "required": ["action"]
+            }
         )
     ]
 
@@ -207,21 +313,24 @@ class ImageGenToolHandler:
 
     async def handle(self, name: str, arguments: dict | None) -> list[types.TextContent | types.ImageContent]:
         prompt = arguments.get("prompt")
-        if not prompt or not self.validate_prompt(prompt):
+        with profiling.stage("validate_prompt"):
+            valid = bool(prompt) and self.validate_prompt(prompt)
+        if not valid:
             return [types.TextContent(
                 type="text", 
                 text="Error: Prompt cannot be empty"
             )]
             
         print(f"Generating image with prompt: {prompt}")
-        result = await generate_image(
-            prompt=prompt,
-            model=arguments.get("model", "fal-ai/ideogram/v2"),
-            aspect_ratio=arguments.get("aspect_ratio", "1:1"),
-            expand_prompt=arguments.get("expand_prompt", True),
-            style=arguments.get("style", "auto"),
-            negative_prompt=arguments.get("negative_prompt", "")
-        )
+        with profiling.stage("generate"):
+            result = await generate_image(
+                prompt=prompt,
+                model=arguments.get("model", "fal-ai/ideogram/v2"),
+                aspect_ratio=arguments.get("aspect_ratio", "1:1"),
+                expand_prompt=arguments.get("expand_prompt", True),
+                style=arguments.get("style", "auto"),
+                negative_prompt=arguments.get("negative_prompt", "")
+            )
         print(f"Image generation result: {result}")
         if result.startswith("http"):
             return [types.TextContent(type="text", text=f"Generated image URL: {result}")]
@@ -245,7 +354,9 @@ class ImageDownloadToolHandler:
         print(f"Downloading image from: {arguments.get('image_url')}")
         result = await download_image_from_url(
             arguments.get("image_url"),
-            arguments.get("output_dir", "downloads")
+            arguments.get("output_dir", "downloads"),
+            arguments.get("skip_duplicates", False),
+            arguments.get("max_distance", 4)
         )
         print(f"Download result: {result}")
         return [types.TextContent(type="text", text=result)]
@@ -255,16 +366,44 @@ class ImageScalingToolHandler:
         print(f"Scaling image: {arguments.get('input_path')}")
         result = await scale_image(
             arguments.get("input_path"),
-            arguments.get("sizes", [(32, 32), (128, 128)])
+            arguments.get("sizes", [(32, 32), (128, 128)]),
+            arguments.get("skip_duplicates", False),
+            arguments.get("max_distance", 4)
         )
         print(f"Scaling result: {result}")
         return [types.TextContent(type="text", text=result)]
 
+class FindSimilarToolHandler:
+    async def handle(self, name: str, arguments: dict | None) -> list[types.TextContent | types.ImageContent]:
+        print(f"Finding images similar to: {arguments.get('image_path')}")
+        result = await find_similar(
+            arguments.get("image_path"),
+            arguments.get("directory", "downloads"),
+            arguments.get("max_distance", 10),
+            arguments.get("method", "phash"),
+            arguments.get("limit", 10)
+        )
+        print(f"Similarity search result: {result}")
+        return [types.TextContent(type="text", text=result)]
+
+class ProfileToolHandler:
+    async def handle(self, name: str, arguments: dict | None) -> list[types.TextContent | types.ImageContent]:
+        print(f"Profile action: {arguments.get('action')}")
+        result = await profiling.profile(
+            arguments.get("action"),
+            arguments.get("duration_seconds", 60),
+            arguments.get("cprofile", True),
+            arguments.get("trace_memory", False)
+        )
+        return [types.TextContent(type="text", text=result)]
+
 tool_handlers = {
     "generate_image": ImageGenToolHandler(),
     "remove_background": BackgroundRemovalToolHandler(),
     "download_image": ImageDownloadToolHandler(),
-    "scale_image": ImageScalingToolHandler()
+    "scale_image": ImageScalingToolHandler(),
+    "find_similar": FindSimilarToolHandler(),
+    "profile": ProfileToolHandler()
 }
 
 @server.call_tool()
@@ -273,27 +412,71 @@ async def handle_call_tool(
     arguments: dict | None
 ) -> list[types.TextContent | types.ImageContent]:
     """Handle tool execution requests."""
-    if name in tool_handlers:
-        return await tool_handlers[name].handle(name, arguments)
-    else:
+    if name not in tool_handlers:
         raise ValueError(f"Unknown tool: {name}")
 
+    options = arguments.get("profile") if arguments else None
+    if options is True or isinstance(options, dict):
+        # Profile just this call and append the summary to its result
+        options = options if isinstance(options, dict) else {}
+        session = profiling.ProfileSession(
+            name,
+            use_cprofile=bool(options.get("cprofile", False)),
+            trace_memory=bool(options.get("trace_memory", False))
+        )
+        session.start()
+        try:
+            with profiling.using(session), profiling.stage(name):
+                result = await dispatch_tool(name, arguments)
+        finally:
+            session.stop()
+        return result + [types.TextContent(type="text", text=session.dump())]
+
+    session = profiling.active_window()
+    if session is None:
+        return await dispatch_tool(name, arguments)
+    with profiling.using(session), profiling.stage(name):
+        return await dispatch_tool(name, arguments)
+
+async def dispatch_tool(
+    name: str,
+    arguments: dict | None
+) -> list[types.TextContent | types.ImageContent]:
+    """Run a tool handler, rate limiting and queueing remote-inference tools for a fair share of slots."""
+    if name not in rate_limiting.RATE_LIMITED_TOOLS:
+        return await tool_handlers[name].handle(name, arguments)
+
+    try:
+        async with rate_limiting.admit(rate_limiting.current_client()):
+            return await tool_handlers[name].handle(name, arguments)
+    except rate_limiting.RateLimitExceeded as e:
+        print(f"Rejected {name} call: {str(e)}")
+        return [types.TextContent(type="text", text=f"Error: {str(e)}")]
+
 async def handle_sse(request):
-    async with sse.connect_sse(
-        request.scope, request.receive, request._send
-    ) as streams:
-        await server.run(
-            streams[0],
-            streams[1],
-            InitializationOptions(
-                server_name="image-gen-server",
-                server_version="0.1.0",
-                capabilities=server.get_capabilities(
-                    notification_options=NotificationOptions(),
-                    experimental_capabilities={},
+    # Tool calls from this connection inherit the client context for rate limiting
+    client = rate_limiting.client_from_headers(request.headers)
+    with rate_limiting.client_session(client):
+        async with sse.connect_sse(
+            request.scope, request.receive, request._send
+        ) as streams:
+            await server.run(
+                streams[0],
+                streams[1],
+                InitializationOptions(
+                    server_name="image-gen-server",
+                    server_version="0.1.0",
+                    capabilities=server.get_capabilities(
+                        notification_options=NotificationOptions(),
+                        experimental_capabilities={},
+                    ),
                 ),
-            ),
-        )
+            )
+
+@app.get("/metrics/scheduler")
+async def scheduler_metrics():
+    """Queue depth, concurrency and rejection counts per client."""
+    return rate_limiting.scheduler.metrics()
 
 @click.command()
 @click.option("--port", default=7777, help="Port to listen on")
@@ -2,10 +2,14 @@ from .image_gen import generate_image
 from .background_removal import remove_background
 from .image_download import download_image_from_url
 from .image_scaling import scale_image
+from .image_hashing import find_similar
+from .profiling import profile
 
 __all__ = [
     'generate_image',
     'remove_background',
     'download_image_from_url',
-    'scale_image'
+    'scale_image',
+    'find_similar',
+    'profile'
 ]
@@ -4,6 +4,7 @@ import fal_client
 import asyncio
 import os
 from .image_download import download_image_from_url
+from .profiling import stage
 
 def is_base64(s: str) -> bool:
     """Check if a string is base64 encoded."""
@@ -32,16 +33,17 @@ async def remove_background(
 
     try:
         loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(
-            None,
-            lambda: fal_client.subscribe(
-                "fal-ai/bria/background/remove",
-                arguments={
-                    "image_url": image_url,
-                    "sync_mode": sync_mode
-                }
+        with stage("fal_subscribe"):
+            result = await loop.run_in_executor(
+                None,
+                lambda: fal_client.subscribe(
+                    "fal-ai/bria/background/remove",
+                    arguments={
+                        "image_url": image_url,
+                        "sync_mode": sync_mode
+                    }
+                )
             )
-        )
         
         # Handle the response according to the new schema
         if isinstance(result, dict) and "image" in result:
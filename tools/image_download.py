@@ -2,13 +2,25 @@ from typing import Optional
 import aiohttp
 import asyncio
 import os
+import tempfile
 from urllib.parse import urlparse
 import mimetypes
+from .image_hashing import find_near_duplicate, record_files
+from .profiling import stage
 
-async def download_image_from_url(image_url: str, output_dir: str = "downloads") -> str:
+async def download_image_from_url(
+    image_url: str,
+    output_dir: str = "downloads",
+    skip_duplicates: bool = False,
+    max_distance: int = 4
+) -> str:
     """
     Download an image from a URL and save it locally.
+
+    With skip_duplicates, the download is discarded if it is a perceptual
+    near-duplicate (within max_distance) of an image already in output_dir.
     """
+    partial_path = None
     try:
         # Create downloads directory if it doesn't exist
         os.makedirs(output_dir, exist_ok=True)
@@ -23,9 +35,15 @@ async def download_image_from_url(image_url: str, output_dir: str = "downloads")
             filename = f"image_{int(asyncio.get_event_loop().time())}{ext}"
 
         output_path = os.path.join(output_dir, filename)
+        # Write to a partial file in a staging directory first, so the hash
+        # index never sees half-written images and output_dir only changes once
+        staging_dir = os.path.join(output_dir, ".partial")
+        os.makedirs(staging_dir, exist_ok=True)
 
         async with aiohttp.ClientSession() as session:
-            async with session.get(image_url) as response:
+            with stage("connect"):
+                response = await session.get(image_url)
+            async with response:
                 if response.status != 200:
                     return f"Error downloading image: HTTP {response.status}"
                 
@@ -34,14 +52,40 @@ async def download_image_from_url(image_url: str, output_dir: str = "downloads")
                 if not content_type.startswith('image/'):
                     return f"Error: URL does not point to an image (content-type: {content_type})"
 
-                # Download and save the image
-                with open(output_path, 'wb') as f:
+                # Download and save the image. The partial file gets a unique
+                # name so concurrent downloads of the same filename don't collide
+                fd, partial_path = tempfile.mkstemp(dir=staging_dir, suffix=".part")
+                with stage("stream"), os.fdopen(fd, 'wb') as f:
                     while True:
                         chunk = await response.content.read(8192)
                         if not chunk:
                             break
                         f.write(chunk)
 
+        if skip_duplicates:
+            loop = asyncio.get_event_loop()
+            with stage("dedup_check"):
+                try:
+                    duplicate = await loop.run_in_executor(
+                        None,
+                        lambda: find_near_duplicate(partial_path, max_distance, directory=output_dir)
+                    )
+                except Exception as e:
+                    # Formats PIL can't decode (e.g. SVG) can't be compared, keep them
+                    print(f"Skipping duplicate check for {filename}: {str(e)}")
+                    duplicate = None
+            if duplicate:
+                return f"Skipped download, near-duplicate of existing image: {duplicate}"
+
+        # mkstemp creates owner-only files, give the image normal permissions
+        os.chmod(partial_path, 0o644)
+        os.replace(partial_path, output_path)
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, lambda: record_files([output_path]))
         return f"Image successfully downloaded to: {output_path}"
     except Exception as e:
-        return f"Error downloading image: {str(e)}" 
\ No newline at end of file
+        return f"Error downloading image: {str(e)}"
+    finally:
+        # Our staged file, if still there, was rejected or failed part way
+        if partial_path and os.path.exists(partial_path):
+            os.remove(partial_path) 
\ No newline at end of file
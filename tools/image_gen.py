@@ -3,6 +3,7 @@ from typing import Optional
 import fal_client
 import asyncio
 import os
+from .profiling import stage
 
 async def generate_image(prompt: str, model: str = "fal-ai/ideogram/v2", aspect_ratio: str = "1:1", expand_prompt: bool = True, style: str = "auto", negative_prompt: str = "") -> str:
     """
@@ -18,21 +19,22 @@ async def generate_image(prompt: str, model: str = "fal-ai/ideogram/v2", aspect_
 
     try:
         loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(
-            None,
-            lambda: fal_client.subscribe(
-                model,
-                arguments={
-                    "prompt": prompt,
-                    "aspect_ratio": aspect_ratio,
-                    "expand_prompt": expand_prompt,
-                    "style": style,
-                    "negative_prompt": negative_prompt
-                },
-                with_logs=True,
-                on_queue_update=on_queue_update,
+        with stage("fal_subscribe"):
+            result = await loop.run_in_executor(
+                None,
+                lambda: fal_client.subscribe(
+                    model,
+                    arguments={
+                        "prompt": prompt,
+                        "aspect_ratio": aspect_ratio,
+                        "expand_prompt": expand_prompt,
+                        "style": style,
+                        "negative_prompt": negative_prompt
+                    },
+                    with_logs=True,
+                    on_queue_update=on_queue_update,
+                )
             )
-        )
         print(f"Raw FAL response: {result}")
         if result and isinstance(result, dict) and "images" in result and len(result["images"]) > 0:
             return result["images"][0]["url"]
@@ -0,0 +1,443 @@
+from PIL import Image
+import asyncio
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+HASH_METHODS = ("ahash", "dhash", "phash")
+# Bumped whenever hashing changes, so cached hashes from older code get recomputed
+HASH_VERSION = 2
+INDEX_FILENAME = ".image_hashes.jsonl"
+# Upper bound on how long files added behind the index's back go unnoticed
+SCAN_INTERVAL = 60.0
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".gif", ".bmp")
+
+# Scaled variants written by scale_image (e.g. logo_32x32.png) are near-duplicates
+# of their source by construction, so they are kept out of the index.
+_SCALED_VARIANT = re.compile(r"_\d+x\d+$")
+
+_DCT_SIZE = 32
+_DCT_KEEP = 8
+_DCT_TABLE = [
+    [math.cos(math.pi * (2 * x + 1) * u / (2 * _DCT_SIZE)) for x in range(_DCT_SIZE)]
+    for u in range(_DCT_KEEP)
+]
+
+
+# All hashes are derived from one small grayscale base, so a full-size image
+# is only decoded, converted and reduced once
+_BASE_SIZE = (64, 64)
+
+
+def prepare_image(img: Image.Image) -> Image.Image:
+    """
+    Reduce an image to the grayscale base the hash functions work on,
+    flattening transparency onto white. Large images are box-reduced with
+    premultiplied alpha first, so the resize and composite only touch a
+    small image and transparent pixels don't bleed their color.
+    """
+    # Lets JPEG decode at a fraction of full resolution, a no-op for other formats
+    img.draft("RGB", _BASE_SIZE)
+    has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+    img = img.convert("RGBA").convert("RGBa") if has_alpha else img.convert("L")
+
+    factor = min(img.width // _BASE_SIZE[0], img.height // _BASE_SIZE[1])
+    if factor > 1:
+        img = img.reduce(factor)
+
+    if has_alpha:
+        small = img.convert("RGBA").resize(_BASE_SIZE, Image.Resampling.LANCZOS)
+        background = Image.new("RGBA", _BASE_SIZE, (255, 255, 255, 255))
+        return Image.alpha_composite(background, small).convert("L")
+    return img.resize(_BASE_SIZE, Image.Resampling.LANCZOS)
+
+
+def _grayscale_pixels(base: Image.Image, size: Tuple[int, int]) -> List[int]:
+    """Downscale a prepared base image to a grayscale pixel list."""
+    return list(base.resize(size, Image.Resampling.LANCZOS).tobytes())
+
+
+def _bits_to_int(bits) -> int:
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+def average_hash(base: Image.Image) -> int:
+    """64-bit aHash: each pixel of an 8x8 thumbnail compared against the mean."""
+    pixels = _grayscale_pixels(base, (8, 8))
+    mean = sum(pixels) / len(pixels)
+    return _bits_to_int(p > mean for p in pixels)
+
+
+def difference_hash(base: Image.Image) -> int:
+    """64-bit dHash: horizontal gradient signs of a 9x8 thumbnail."""
+    pixels = _grayscale_pixels(base, (9, 8))
+    return _bits_to_int(
+        pixels[row * 9 + col] > pixels[row * 9 + col + 1]
+        for row in range(8)
+        for col in range(8)
+    )
+
+
+def perceptual_hash(base: Image.Image) -> int:
+    """64-bit pHash: low-frequency DCT coefficients of a 32x32 thumbnail vs. their median."""
+    pixels = _grayscale_pixels(base, (_DCT_SIZE, _DCT_SIZE))
+    rows = [pixels[i * _DCT_SIZE:(i + 1) * _DCT_SIZE] for i in range(_DCT_SIZE)]
+
+    # Separable DCT-II, only computing the 8x8 low-frequency block we keep
+    row_coeffs = [
+        [sum(c * p for c, p in zip(basis, row)) for basis in _DCT_TABLE]
+        for row in rows
+    ]
+    coeffs = [
+        sum(_DCT_TABLE[u][y] * row_coeffs[y][v] for y in range(_DCT_SIZE))
+        for u in range(_DCT_KEEP)
+        for v in range(_DCT_KEEP)
+    ]
+
+    # The DC term only reflects overall brightness, leave it out of the median
+    median = sorted(coeffs[1:])[len(coeffs[1:]) // 2]
+    return _bits_to_int(c > median for c in coeffs)
+
+
+def compute_hashes(image_path: str) -> Dict[str, int]:
+    """Compute all supported perceptual hashes for an image file."""
+    with Image.open(image_path) as img:
+        base = prepare_image(img)
+    return {
+        "ahash": average_hash(base),
+        "dhash": difference_hash(base),
+        "phash": perceptual_hash(base),
+    }
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+_BANDS = 4
+_BAND_BITS = 64 // _BANDS
+_BAND_MASK = (1 << _BAND_BITS) - 1
+# Beyond this per-band radius the probe count outgrows a linear scan
+_MAX_BAND_RADIUS = 3
+_neighbor_masks: Dict[int, List[int]] = {}
+
+
+def _band_neighbors(radius: int) -> List[int]:
+    """All band-sized XOR masks with at most radius bits set."""
+    masks = _neighbor_masks.get(radius)
+    if masks is None:
+        masks = _neighbor_masks[radius] = [m for m in range(1 << _BAND_BITS) if m.bit_count() <= radius]
+    return masks
+
+
+class MultiIndexHash:
+    """
+    Multi-index hashing over 64-bit hashes.
+
+    Each hash is split into four 16-bit bands, each with its own lookup table.
+    If two hashes are within radius r, at least one band differs in at most
+    r // 4 bits (pigeonhole), so probing every band's neighbors within that
+    sub-radius finds all candidates without touching the rest of the index.
+    """
+
+    def __init__(self):
+        self.values: Dict[str, int] = {}
+        self.tables: List[Dict[int, set]] = [{} for _ in range(_BANDS)]
+
+    @staticmethod
+    def _bands(value: int):
+        return ((value >> (band * _BAND_BITS)) & _BAND_MASK for band in range(_BANDS))
+
+    def add(self, item: str, value: int) -> None:
+        self.remove(item)
+        self.values[item] = value
+        for table, key in zip(self.tables, self._bands(value)):
+            table.setdefault(key, set()).add(item)
+
+    def remove(self, item: str) -> None:
+        value = self.values.pop(item, None)
+        if value is None:
+            return
+        for table, key in zip(self.tables, self._bands(value)):
+            bucket = table[key]
+            bucket.discard(item)
+            if not bucket:
+                del table[key]
+
+    def search(self, value: int, radius: int) -> List[Tuple[int, str]]:
+        """Return (distance, item) pairs within radius of value, closest first."""
+        band_radius = radius // _BANDS
+        if band_radius > _MAX_BAND_RADIUS:
+            candidates = self.values.keys()
+        else:
+            candidates = set()
+            masks = _band_neighbors(band_radius)
+            for table, key in zip(self.tables, self._bands(value)):
+                for mask in masks:
+                    bucket = table.get(key ^ mask)
+                    if bucket:
+                        candidates.update(bucket)
+
+        results = []
+        for item in candidates:
+            distance = hamming_distance(value, self.values[item])
+            if distance <= radius:
+                results.append((distance, item))
+        results.sort()
+        return results
+
+
+class ImageHashIndex:
+    """
+    Perceptual hash index over the images in a directory.
+
+    Hashes are cached in an append-only JSON-lines sidecar, later lines taking
+    precedence, so only new or modified files are hashed and written. The
+    directory is only rescanned when its mtime changes or SCAN_INTERVAL has
+    passed; tools that write images call add_files so their own writes don't
+    force a rescan. Lookups run in executor threads, so all access to the
+    entries and tables goes through self.lock.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = os.path.abspath(directory)
+        self.index_path = os.path.join(self.directory, INDEX_FILENAME)
+        self.entries: Dict[str, dict] = {}
+        self.tables: Dict[str, MultiIndexHash] = {method: MultiIndexHash() for method in HASH_METHODS}
+        self.lock = threading.Lock()
+        self.scanned_mtime: Optional[int] = None
+        self.scanned_at = 0.0
+        self._load()
+        for name, entry in self.entries.items():
+            self._insert(name, entry)
+
+    def _load(self) -> None:
+        try:
+            with open(self.index_path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        name = entry.pop("name")
+                    except (ValueError, KeyError, AttributeError):
+                        # Tolerate a line cut short by a crash mid-append
+                        continue
+                    # Hashes from an older HASH_VERSION are left for the next scan to redo
+                    if entry.get("version") == HASH_VERSION:
+                        self.entries[name] = entry
+        except OSError:
+            self.entries = {}
+
+    def _append(self, names: List[str]) -> None:
+        with open(self.index_path, "a") as f:
+            for name in names:
+                f.write(json.dumps({"name": name, **self.entries[name]}) + "\n")
+
+    def _rewrite(self) -> None:
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self.directory, prefix=INDEX_FILENAME, suffix=".tmp", delete=False
+        ) as f:
+            tmp_path = f.name
+            try:
+                for name, entry in self.entries.items():
+                    f.write(json.dumps({"name": name, **entry}) + "\n")
+            except Exception:
+                f.close()
+                os.remove(tmp_path)
+                raise
+        os.replace(tmp_path, self.index_path)
+
+    def _insert(self, name: str, entry: dict) -> None:
+        for method in HASH_METHODS:
+            self.tables[method].add(name, entry[method])
+
+    def _hash_file(self, name: str, mtime: float) -> bool:
+        try:
+            hashes = compute_hashes(os.path.join(self.directory, name))
+        except Exception as e:
+            print(f"Skipping {name} in hash index: {str(e)}")
+            return False
+        self.entries[name] = {"mtime": mtime, "version": HASH_VERSION, **hashes}
+        self._insert(name, self.entries[name])
+        return True
+
+    @staticmethod
+    def is_indexable(filename: str) -> bool:
+        stem, ext = os.path.splitext(filename)
+        return ext.lower() in IMAGE_EXTENSIONS and not _SCALED_VARIANT.search(stem)
+
+    def refresh(self, force: bool = False) -> None:
+        """Rescan the directory if it changed since the last scan or the scan is stale."""
+        try:
+            dir_mtime = os.stat(self.directory).st_mtime_ns
+        except OSError:
+            return
+        with self.lock:
+            fresh = time.monotonic() - self.scanned_at < SCAN_INTERVAL
+            if not force and fresh and dir_mtime == self.scanned_mtime:
+                return
+            self._scan(dir_mtime)
+
+    def _scan(self, dir_mtime: int) -> None:
+        current = {}
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and self.is_indexable(entry.name):
+                current[entry.name] = entry.stat().st_mtime
+
+        deleted = [name for name in self.entries if name not in current]
+        for name in deleted:
+            del self.entries[name]
+            for table in self.tables.values():
+                table.remove(name)
+
+        changed = [
+            name for name, mtime in current.items()
+            if name not in self.entries or self.entries[name]["mtime"] != mtime
+        ]
+        changed = [name for name in changed if self._hash_file(name, current[name])]
+
+        if deleted:
+            self._rewrite()
+            # Replacing the sidecar changes the directory mtime itself
+            dir_mtime = os.stat(self.directory).st_mtime_ns
+        elif changed:
+            self._append(changed)
+            dir_mtime = os.stat(self.directory).st_mtime_ns
+        self.scanned_mtime = dir_mtime
+        self.scanned_at = time.monotonic()
+
+    def add_files(self, paths: List[str]) -> None:
+        """
+        Index files just written into the directory and mark the directory as
+        scanned, so the writer's own change doesn't trigger a full rescan.
+        Anything else that changed at the same moment is picked up once
+        SCAN_INTERVAL has passed.
+        """
+        with self.lock:
+            added = []
+            for path in paths:
+                name = os.path.basename(path)
+                if not self.is_indexable(name):
+                    continue
+                if self._hash_file(name, os.stat(path).st_mtime):
+                    added.append(name)
+            if added:
+                self._append(added)
+            if self.scanned_mtime is not None:
+                self.scanned_mtime = os.stat(self.directory).st_mtime_ns
+
+    def find_similar(
+        self,
+        image_path: str,
+        max_distance: int = 10,
+        method: str = "phash",
+        limit: int = 10
+    ) -> List[Tuple[int, str]]:
+        """Return (distance, path) pairs for indexed images near image_path."""
+        if method not in HASH_METHODS:
+            raise ValueError(f"Unknown hash method: {method}")
+
+        image_path = os.path.abspath(image_path)
+        name = os.path.basename(image_path)
+        with self.lock:
+            entry = self.entries.get(name) if os.path.dirname(image_path) == self.directory else None
+        query = entry[method] if entry else compute_hashes(image_path)[method]
+
+        with self.lock:
+            candidates = self.tables[method].search(query, max_distance)
+
+        matches = []
+        for distance, filename in candidates:
+            if len(matches) >= limit:
+                break
+            path = os.path.join(self.directory, filename)
+            if path == image_path:
+                continue
+            matches.append((distance, path))
+        return matches
+
+
+_indexes: Dict[str, ImageHashIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(directory: str = "downloads") -> ImageHashIndex:
+    """Return the refreshed hash index for a directory, loading it on first use."""
+    key = os.path.abspath(directory)
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = ImageHashIndex(key)
+        index = _indexes[key]
+    index.refresh()
+    return index
+
+
+def record_files(paths: List[str]) -> None:
+    """Tell an already loaded index about images just written to its directory."""
+    by_directory: Dict[str, List[str]] = {}
+    for path in paths:
+        by_directory.setdefault(os.path.dirname(os.path.abspath(path)), []).append(path)
+    for directory, dir_paths in by_directory.items():
+        with _indexes_lock:
+            index = _indexes.get(directory)
+        if index is not None:
+            index.add_files(dir_paths)
+
+
+def find_near_duplicate(
+    image_path: str,
+    max_distance: int = 4,
+    method: str = "phash",
+    directory: Optional[str] = None
+) -> Optional[str]:
+    """Return the closest indexed image within max_distance, searching image_path's directory by default."""
+    index = get_index(directory or os.path.dirname(image_path) or ".")
+    matches = index.find_similar(image_path, max_distance, method, limit=1)
+    return matches[0][1] if matches else None
+
+
+async def find_similar(
+    image_path: str,
+    directory: str = "downloads",
+    max_distance: int = 10,
+    method: str = "phash",
+    limit: int = 10
+) -> str:
+    """
+    Find previously generated images that look like the given image.
+
+    Args:
+        image_path: Path to the query image
+        directory: Directory of past images to search
+        max_distance: Maximum Hamming distance (0-64) between 64-bit hashes
+        method: Hash to compare with: 'ahash', 'dhash' or 'phash'
+        limit: Maximum number of matches to return
+
+    Returns:
+        str: Matching image paths with their distances, or an error message
+    """
+    try:
+        if not os.path.exists(image_path):
+            return f"Error: Input file {image_path} does not exist"
+        if method not in HASH_METHODS:
+            return f"Error: Unknown hash method {method}, expected one of {', '.join(HASH_METHODS)}"
+
+        loop = asyncio.get_event_loop()
+        matches = await loop.run_in_executor(
+            None,
+            lambda: get_index(directory).find_similar(image_path, max_distance, method, limit)
+        )
+
+        if not matches:
+            return f"No similar images found within distance {max_distance}"
+        lines = [f"{path} (distance {distance})" for distance, path in matches]
+        return f"Found {len(matches)} similar images:\n" + "\n".join(lines)
+    except Exception as e:
+        return f"Error finding similar images: {str(e)}"
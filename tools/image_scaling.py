@@ -1,14 +1,30 @@
 from PIL import Image
+import asyncio
 import os
 from typing import List, Tuple
+from .image_hashing import find_near_duplicate, record_files
+from .profiling import stage
 
-async def scale_image(input_path: str, sizes: List[Tuple[int, int]] = [(32, 32), (128, 128)]) -> str:
+def _scaled_path(input_path: str, width: int, height: int) -> str:
+    directory = os.path.dirname(input_path)
+    filename = os.path.splitext(os.path.basename(input_path))[0]
+    return os.path.join(directory, f"{filename}_{width}x{height}.png")
+
+async def scale_image(
+    input_path: str,
+    sizes: List[Tuple[int, int]] = [(32, 32), (128, 128)],
+    skip_duplicates: bool = False,
+    max_distance: int = 4
+) -> str:
     """
     Scale an image to multiple specified sizes while preserving transparency.
     
     Args:
         input_path: Path to the input image
         sizes: List of (width, height) tuples for desired output sizes
+        skip_duplicates: Reuse the scaled versions of a near-duplicate image
+            in the same directory instead of resizing again
+        max_distance: Maximum perceptual hash distance for a near-duplicate
     
     Returns:
         str: Message indicating where the scaled images were saved
@@ -17,31 +33,48 @@ async def scale_image(input_path: str, sizes: List[Tuple[int, int]] = [(32, 32),
         if not os.path.exists(input_path):
             return f"Error: Input file {input_path} does not exist"
 
+        if skip_duplicates:
+            # Hashing can touch the whole directory, keep it off the event loop
+            loop = asyncio.get_event_loop()
+            with stage("dedup_check"):
+                duplicate = await loop.run_in_executor(
+                    None,
+                    lambda: find_near_duplicate(input_path, max_distance)
+                )
+            if duplicate:
+                existing = [_scaled_path(duplicate, width, height) for width, height in sizes]
+                if all(os.path.exists(path) for path in existing):
+                    return f"Skipped scaling, near-duplicate of {duplicate} already has scaled versions: {', '.join(existing)}"
+
         # Open the image while preserving transparency
         with Image.open(input_path) as img:
             # Convert to RGBA if not already
-            if img.mode != 'RGBA':
-                img = img.convert('RGBA')
-            
-            # Get the base filename and directory
-            directory = os.path.dirname(input_path)
-            filename = os.path.splitext(os.path.basename(input_path))[0]
+            with stage("decode"):
+                if img.mode != 'RGBA':
+                    img = img.convert('RGBA')
+                else:
+                    img.load()
             
             scaled_files = []
             # Create scaled versions
             for width, height in sizes:
                 # Resize the image using high-quality resampling
-                scaled = img.resize((width, height), Image.Resampling.LANCZOS)
+                with stage("resize"):
+                    scaled = img.resize((width, height), Image.Resampling.LANCZOS)
                 
                 # Generate output filename
-                output_filename = f"{filename}_{width}x{height}.png"
-                output_path = os.path.join(directory, output_filename)
+                output_path = _scaled_path(input_path, width, height)
                 
                 # Save with transparency
-                scaled.save(output_path, "PNG")
+                with stage("encode"):
+                    scaled.save(output_path, "PNG")
                 scaled_files.append(output_path)
-            
-            return f"Successfully created scaled versions: {', '.join(scaled_files)}"
+
+        # Scaled variants aren't indexed, but writing them changes the
+        # directory; let a loaded hash index know so it doesn't rescan
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, lambda: record_files(scaled_files))
+        return f"Successfully created scaled versions: {', '.join(scaled_files)}"
             
     except Exception as e:
         return f"Error scaling image: {str(e)}" 
\ No newline at end of file
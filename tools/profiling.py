@@ -0,0 +1,291 @@
+import asyncio
+import contextlib
+import contextvars
+import cProfile
+import math
+import os
+import pstats
+import time
+import tracemalloc
+from typing import Dict, Optional, Tuple
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+# The active session for the current task, and the stage path within it
+_current: contextvars.ContextVar[Optional["ProfileSession"]] = contextvars.ContextVar("profile_session", default=None)
+_path: contextvars.ContextVar[Tuple[str, ...]] = contextvars.ContextVar("profile_path", default=())
+
+# cProfile and tracemalloc are process-global, so overlapping sessions share
+# them and they are only turned off when the last session using them stops
+_cprofile: Optional[cProfile.Profile] = None
+_cprofile_users = 0
+_tracemalloc_users = 0
+_tracemalloc_started = False
+
+_window: Optional["ProfileSession"] = None
+_window_timer: Optional[asyncio.TimerHandle] = None
+_last_dump: Optional[str] = None
+
+_NULL_STAGE = contextlib.nullcontext()
+
+# Keep tracemalloc's own snapshot bookkeeping out of allocation reports
+_SNAPSHOT_FILTERS = [tracemalloc.Filter(False, tracemalloc.__file__)]
+
+
+class StageStats:
+    __slots__ = ("calls", "wall", "cpu", "alloc")
+
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.alloc = 0
+
+
+class ProfileSession:
+    """
+    Collects per-stage timings for one request or one profiling window.
+
+    Wall time comes from perf_counter and CPU time from process_time, so CPU
+    includes executor threads and any requests running concurrently. With
+    trace_memory, each stage also records its net traced allocation and the
+    session reports the allocation sites that grew between its start and stop
+    snapshots (process-wide, so including concurrent requests). When
+    sessions overlap they share one cProfile profiler, so a session's cProfile
+    stats cover everything on the loop since the earliest of them started.
+    """
+
+    def __init__(self, label: str, use_cprofile: bool = False, trace_memory: bool = False):
+        self.label = label
+        self.use_cprofile = use_cprofile
+        self.trace_memory = trace_memory
+        self.stages: Dict[Tuple[str, ...], StageStats] = {}
+        self.profiler: Optional[cProfile.Profile] = None
+        self.cprofile_stats: Optional[pstats.Stats] = None
+        self.started_at = time.time()
+        self.deadline: Optional[float] = None
+        self.start_snapshot: Optional[tracemalloc.Snapshot] = None
+        self.allocation_diff = []
+
+    def start(self) -> None:
+        global _cprofile, _cprofile_users, _tracemalloc_users, _tracemalloc_started
+        if self.use_cprofile:
+            if _cprofile is None:
+                _cprofile = cProfile.Profile()
+                _cprofile.enable()
+            _cprofile_users += 1
+            self.profiler = _cprofile
+        if self.trace_memory:
+            if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                _tracemalloc_started = True
+            _tracemalloc_users += 1
+            # Baseline, so allocations made before this session aren't attributed to it
+            self.start_snapshot = tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS)
+
+    def stop(self) -> None:
+        global _cprofile, _cprofile_users, _tracemalloc_users, _tracemalloc_started
+        if self.profiler is not None:
+            # Collecting stats disables the profiler, turn it back on for the others
+            self.cprofile_stats = pstats.Stats(self.profiler)
+            _cprofile_users -= 1
+            if _cprofile_users == 0:
+                _cprofile = None
+            else:
+                self.profiler.enable()
+            self.profiler = None
+        if self.trace_memory:
+            if tracemalloc.is_tracing() and self.start_snapshot is not None:
+                snapshot = tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS)
+                self.allocation_diff = snapshot.compare_to(self.start_snapshot, "lineno")
+                self.start_snapshot = None
+            _tracemalloc_users -= 1
+            if _tracemalloc_users == 0 and _tracemalloc_started:
+                tracemalloc.stop()
+                _tracemalloc_started = False
+
+    def record(self, path: Tuple[str, ...], wall: float, cpu: float, alloc: int) -> None:
+        stats = self.stages.get(path)
+        if stats is None:
+            stats = self.stages[path] = StageStats()
+        stats.calls += 1
+        stats.wall += wall
+        stats.cpu += cpu
+        stats.alloc += alloc
+
+    def folded_stacks(self) -> str:
+        """
+        Stage self-times in collapsed-stack format ("a;b;c <microseconds>"),
+        readable by flamegraph.pl, speedscope and inferno.
+        """
+        self_time = {path: stats.wall for path, stats in self.stages.items()}
+        for path, stats in self.stages.items():
+            parent = path[:-1]
+            if parent in self_time:
+                self_time[parent] -= stats.wall
+        lines = [
+            f"{';'.join(path)} {max(int(seconds * 1_000_000), 0)}"
+            for path, seconds in sorted(self_time.items())
+        ]
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        lines = [f"Profile '{self.label}':"]
+        for path, stats in sorted(self.stages.items()):
+            line = (
+                f"  {' > '.join(path)}: {stats.calls} calls, "
+                f"wall {stats.wall * 1000:.1f}ms, cpu {stats.cpu * 1000:.1f}ms"
+            )
+            if self.trace_memory:
+                line += f", alloc {stats.alloc / 1024:.1f}KiB"
+            lines.append(line)
+        if self.allocation_diff:
+            lines.append("  Top allocation sites during this session:")
+            for stat in self.allocation_diff[:5]:
+                lines.append(f"    {stat}")
+        return "\n".join(lines)
+
+    def dump(self, output_dir: str = PROFILE_DIR) -> str:
+        """Write the folded stacks (and cProfile stats, if any) and return a summary."""
+        global _last_dump
+        os.makedirs(output_dir, exist_ok=True)
+        base = os.path.join(output_dir, f"{self.label}_{int(self.started_at * 1000)}")
+
+        with open(f"{base}.folded", "w") as f:
+            f.write(self.folded_stacks())
+        written = [f"{base}.folded"]
+        if self.cprofile_stats is not None:
+            self.cprofile_stats.dump_stats(f"{base}.prof")
+            written.append(f"{base}.prof")
+
+        _last_dump = f"{self.summary()}\nWritten: {', '.join(written)}"
+        return _last_dump
+
+
+class _Stage:
+    __slots__ = ("session", "name", "path", "token", "wall", "cpu", "mem")
+
+    def __init__(self, session: ProfileSession, name: str):
+        self.session = session
+        self.name = name
+
+    def __enter__(self):
+        self.path = _path.get() + (self.name,)
+        self.token = _path.set(self.path)
+        self.mem = tracemalloc.get_traced_memory()[0] if self.session.trace_memory else 0
+        self.cpu = time.process_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        alloc = tracemalloc.get_traced_memory()[0] - self.mem if self.session.trace_memory else 0
+        _path.reset(self.token)
+        self.session.record(self.path, wall, cpu, alloc)
+        return False
+
+
+def stage(name: str):
+    """
+    Time a block as a named stage of the active profile session.
+
+    Returns a shared no-op context manager when profiling is off, so the cost
+    of an instrumented block is a single context variable lookup.
+    """
+    session = _current.get()
+    if session is None:
+        return _NULL_STAGE
+    return _Stage(session, name)
+
+
+@contextlib.contextmanager
+def using(session: Optional[ProfileSession]):
+    """Make session the active profile session for the current task."""
+    token = _current.set(session)
+    try:
+        yield session
+    finally:
+        _current.reset(token)
+
+
+def active_window() -> Optional[ProfileSession]:
+    """Return the profiling window session if one is running."""
+    return _window
+
+
+def start_window(duration: float, use_cprofile: bool = False, trace_memory: bool = False) -> str:
+    global _window, _window_timer
+    if _window is not None:
+        return f"Error: a profiling window is already running until {time.ctime(_window.deadline)}"
+    try:
+        duration = float(duration)
+    except (TypeError, ValueError):
+        return f"Error: duration_seconds must be a number, got {duration!r}"
+    if not math.isfinite(duration) or duration <= 0:
+        return f"Error: duration_seconds must be a positive number, got {duration:g}"
+
+    # Only publish the window once it is fully running, so a failure here
+    # can't leave handle_call_tool routing calls into a half-built session
+    session = ProfileSession("window", use_cprofile, trace_memory)
+    session.deadline = time.time() + duration
+    session.start()
+    try:
+        timer = asyncio.get_event_loop().call_later(duration, stop_window)
+    except Exception:
+        session.stop()
+        raise
+    _window, _window_timer = session, timer
+    return f"Profiling enabled for {duration:g}s, results will be written to {PROFILE_DIR}"
+
+
+def stop_window() -> str:
+    global _window, _window_timer
+    if _window is None:
+        return "No profiling window is running"
+    if _window_timer is not None:
+        _window_timer.cancel()
+        _window_timer = None
+
+    session, _window = _window, None
+    session.stop()
+    return session.dump()
+
+
+def status() -> str:
+    if _window is not None:
+        remaining = max(_window.deadline - time.time(), 0)
+        return f"Profiling window running, {remaining:.0f}s left\n{_window.summary()}"
+    if _last_dump is not None:
+        return f"No profiling window is running. Last profile:\n{_last_dump}"
+    return "No profiling window is running"
+
+
+async def profile(
+    action: str,
+    duration_seconds: float = 60,
+    cprofile: bool = True,
+    trace_memory: bool = False
+) -> str:
+    """
+    Control the time-window profiler.
+
+    Args:
+        action: 'start' a window, 'stop' it and dump results, or report 'status'
+        duration_seconds: How long the window stays open before dumping itself
+        cprofile: Also run cProfile on the event loop thread
+        trace_memory: Record per-stage allocations with tracemalloc
+
+    Returns:
+        str: Status message or profile summary
+    """
+    try:
+        if action == "start":
+            return start_window(duration_seconds, cprofile, trace_memory)
+        if action == "stop":
+            return stop_window()
+        if action == "status":
+            return status()
+        return f"Error: Unknown profile action {action}"
+    except Exception as e:
+        return f"Error profiling: {str(e)}"
@@ -0,0 +1,352 @@
+import asyncio
+import contextlib
+import contextvars
+import hashlib
+import heapq
+import itertools
+import math
+import os
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+from .profiling import stage
+
+# Tools that call out to FAL and hold an executor thread while they wait
+RATE_LIMITED_TOOLS = {"generate_image", "remove_background"}
+
+
+def _parse_number(value: str, cast=float, allow_zero: bool = False):
+    """Parse a finite positive number (or zero if allowed), None if invalid."""
+    try:
+        number = cast(value)
+    except ValueError:
+        return None
+    if not math.isfinite(number) or number < 0 or (number == 0 and not allow_zero):
+        return None
+    return number
+
+
+def _env_number(name: str, default, cast=float, allow_zero: bool = False):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    number = _parse_number(value, cast, allow_zero)
+    if number is None:
+        print(f"Warning: ignoring invalid {name}={value!r}, using {default}")
+        return default
+    return number
+
+
+SESSION_RATE_PER_MINUTE = _env_number("RATE_LIMIT_SESSION_PER_MINUTE", 10.0)
+SESSION_BURST = _env_number("RATE_LIMIT_SESSION_BURST", 5, int)
+API_KEY_RATE_PER_MINUTE = _env_number("RATE_LIMIT_API_KEY_PER_MINUTE", 30.0)
+API_KEY_BURST = _env_number("RATE_LIMIT_API_KEY_BURST", 10, int)
+MAX_CONCURRENT = _env_number("RATE_LIMIT_MAX_CONCURRENT", 4, int)
+MAX_QUEUED_PER_CLIENT = _env_number("RATE_LIMIT_MAX_QUEUED_PER_CLIENT", 8, int, allow_zero=True)
+
+
+def _parse_weights(spec: str) -> Dict[str, float]:
+    """Parse "key1=4,key2=0.5" into fair-queue weights keyed by API key."""
+    weights = {}
+    for item in spec.split(","):
+        key, sep, weight = item.strip().partition("=")
+        if not (sep and key):
+            continue
+        # Zero or negative weights would divide by zero or run tags backwards
+        number = _parse_number(weight)
+        if number is None:
+            print(f"Warning: ignoring invalid fair-queue weight {weight!r} for an API key")
+            continue
+        weights[key] = number
+    return weights
+
+API_KEY_WEIGHTS = _parse_weights(os.getenv("RATE_LIMIT_API_KEY_WEIGHTS", ""))
+# Keys aren't authenticated, so only configured ones get per-key state;
+# anything else is limited per session and can't grow the key tables
+KNOWN_API_KEYS = {
+    key.strip() for key in os.getenv("RATE_LIMIT_API_KEYS", "").split(",") if key.strip()
+} | set(API_KEY_WEIGHTS)
+
+
+class RateLimitExceeded(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(f"{reason}, retry after {retry_after:.1f}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class ClientInfo:
+    """Identity of the SSE client making the current request."""
+
+    def __init__(self, session_id: str, api_key: Optional[str] = None):
+        self.session_id = session_id
+        self.api_key = api_key
+        # Never expose raw keys in metrics or error messages
+        self.key_id = hashlib.sha256(api_key.encode()).hexdigest()[:12] if api_key else None
+        self.weight = API_KEY_WEIGHTS.get(api_key, 1.0) if api_key else 1.0
+
+    @property
+    def queue_key(self) -> str:
+        # Sessions sharing an API key share one fair-queue slot
+        return f"key:{self.key_id}" if self.key_id else f"session:{self.session_id}"
+
+
+_client: contextvars.ContextVar[Optional[ClientInfo]] = contextvars.ContextVar("rate_limit_client", default=None)
+_anonymous = ClientInfo("anonymous")
+
+
+def client_from_headers(headers) -> ClientInfo:
+    """Build a ClientInfo for a new SSE connection from its request headers."""
+    api_key = headers.get("x-api-key")
+    authorization = headers.get("authorization", "")
+    if not api_key and authorization.lower().startswith("bearer "):
+        api_key = authorization[7:].strip()
+    if api_key not in KNOWN_API_KEYS:
+        api_key = None
+    return ClientInfo(uuid.uuid4().hex[:12], api_key)
+
+
+@contextlib.contextmanager
+def client_session(client: ClientInfo):
+    """Attribute requests handled within this block to client, dropping its session state afterwards."""
+    token = _client.set(client)
+    try:
+        yield client
+    finally:
+        _client.reset(token)
+        _session_buckets.pop(client.session_id, None)
+        scheduler.forget(f"session:{client.session_id}")
+
+
+def current_client() -> ClientInfo:
+    return _client.get() or _anonymous
+
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at rate tokens per second."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def retry_after(self, now: float) -> float:
+        """Seconds until a token is available, 0 if one is available now."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def consume(self) -> None:
+        self.tokens -= 1
+
+    def refund(self) -> None:
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+
+_session_buckets: Dict[str, TokenBucket] = {}
+_api_key_buckets: Dict[str, TokenBucket] = {}
+
+
+def check_rate_limit(client: ClientInfo) -> List[TokenBucket]:
+    """
+    Take one token from the client's session bucket and, if it sent an API
+    key, from that key's bucket, returning the buckets charged. Raises
+    RateLimitExceeded without consuming anything if either bucket is empty.
+    """
+    now = time.monotonic()
+    session_bucket = _session_buckets.get(client.session_id)
+    if session_bucket is None:
+        session_bucket = _session_buckets[client.session_id] = TokenBucket(SESSION_RATE_PER_MINUTE / 60, SESSION_BURST)
+    buckets = [("session", session_bucket)]
+    if client.key_id:
+        key_bucket = _api_key_buckets.get(client.key_id)
+        if key_bucket is None:
+            key_bucket = _api_key_buckets[client.key_id] = TokenBucket(API_KEY_RATE_PER_MINUTE / 60, API_KEY_BURST)
+        buckets.append(("API key", key_bucket))
+
+    for scope, bucket in buckets:
+        wait = bucket.retry_after(now)
+        if wait > 0:
+            scheduler.count_rejection(client.queue_key)
+            raise RateLimitExceeded(f"Rate limit exceeded for this {scope}", wait)
+    for _, bucket in buckets:
+        bucket.consume()
+    return [bucket for _, bucket in buckets]
+
+
+@contextlib.asynccontextmanager
+async def admit(client: ClientInfo):
+    """
+    Charge the client's rate limits and hold a fair-queue slot for the block.
+    Tokens are refunded if the call never runs because the queue rejected it
+    or it was cancelled while waiting.
+    """
+    charged = check_rate_limit(client)
+    try:
+        with stage("queue_wait"):
+            await scheduler.acquire(client)
+    except BaseException:
+        for bucket in charged:
+            bucket.refund()
+        raise
+    async with scheduler.hold(client):
+        yield
+
+
+class ClientStats:
+    __slots__ = ("queued", "running", "admitted", "rejected", "max_queued", "last_finish")
+
+    def __init__(self):
+        self.queued = 0
+        self.running = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.max_queued = 0
+        self.last_finish = 0.0
+
+
+class FairScheduler:
+    """
+    Weighted fair queue limiting how many remote-inference calls run at once.
+
+    Each request gets a virtual finish tag of max(virtual time, the client's
+    previous tag) + 1 / weight, and free slots go to the smallest tag. A
+    client flooding the queue only pushes its own tags further out, so other
+    clients keep getting served at their share.
+    """
+
+    def __init__(self, max_concurrent: int, max_queued_per_client: int):
+        if max_concurrent < 1:
+            raise ValueError(f"max_concurrent must be at least 1, got {max_concurrent}")
+        self.max_concurrent = max_concurrent
+        self.max_queued_per_client = max_queued_per_client
+        self.running = 0
+        self.virtual_time = 0.0
+        self.waiters: List[Tuple[float, int, str, asyncio.Future]] = []
+        self.clients: Dict[str, ClientStats] = {}
+        # Disconnected clients whose stats go once their last call finishes
+        self.closing = set()
+        self._sequence = itertools.count()
+        # Moving average of slot hold time, used for queue-full retry hints
+        self.avg_service_time = 10.0
+
+    def _stats(self, key: str) -> ClientStats:
+        stats = self.clients.get(key)
+        if stats is None:
+            stats = self.clients[key] = ClientStats()
+        return stats
+
+    def _finish_tag(self, stats: ClientStats, weight: float) -> float:
+        stats.last_finish = max(self.virtual_time, stats.last_finish) + 1 / weight
+        return stats.last_finish
+
+    def count_rejection(self, key: str) -> None:
+        self._stats(key).rejected += 1
+
+    def forget(self, key: str) -> None:
+        """Drop the stats of a disconnected client once it has nothing in flight."""
+        if key in self.clients:
+            self.closing.add(key)
+            self._drop_if_closed(key)
+
+    def _drop_if_closed(self, key: str) -> None:
+        stats = self.clients.get(key)
+        if key in self.closing and stats is not None and stats.queued == 0 and stats.running == 0:
+            del self.clients[key]
+            self.closing.discard(key)
+
+    async def acquire(self, client: ClientInfo) -> None:
+        key = client.queue_key
+        stats = self._stats(key)
+
+        if self.running < self.max_concurrent:
+            # release() grants slots while any are free, so whatever is left
+            # in the heap here belongs to cancelled waiters
+            self.waiters.clear()
+            self.virtual_time = self._finish_tag(stats, client.weight)
+            self._start(stats)
+            return
+
+        if stats.queued >= self.max_queued_per_client:
+            stats.rejected += 1
+            raise RateLimitExceeded("Too many queued requests for this client", self._retry_hint(stats))
+
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self.waiters, (self._finish_tag(stats, client.weight), next(self._sequence), key, future))
+        stats.queued += 1
+        stats.max_queued = max(stats.max_queued, stats.queued)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Cancelled after being granted a slot, hand it on
+                self.release(key)
+            raise
+        finally:
+            stats.queued -= 1
+            self._drop_if_closed(key)
+
+    def _retry_hint(self, stats: ClientStats) -> float:
+        """
+        Estimate when the client's queue will have room. Under fair sharing
+        its own backlog drains at about max_concurrent / active clients, and
+        never slower than the whole live queue would.
+        """
+        active = [s for s in self.clients.values() if s.queued or s.running]
+        total_queued = sum(s.queued for s in active)
+        ahead = min(total_queued, stats.queued * len(active))
+        return self.avg_service_time * (ahead / self.max_concurrent + 1)
+
+    def _start(self, stats: ClientStats) -> None:
+        self.running += 1
+        stats.running += 1
+        stats.admitted += 1
+
+    def release(self, key: str) -> None:
+        self.running -= 1
+        self._stats(key).running -= 1
+        self._drop_if_closed(key)
+        while self.waiters and self.running < self.max_concurrent:
+            finish, _, waiter_key, future = heapq.heappop(self.waiters)
+            if future.done():
+                continue
+            self.virtual_time = finish
+            self._start(self._stats(waiter_key))
+            future.set_result(None)
+
+    @contextlib.asynccontextmanager
+    async def hold(self, client: ClientInfo):
+        """Run the block in a slot already taken with acquire(), releasing it afterwards."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.avg_service_time = 0.8 * self.avg_service_time + 0.2 * (time.monotonic() - started)
+            self.release(client.queue_key)
+
+    def metrics(self) -> dict:
+        return {
+            "running": self.running,
+            "queued": sum(stats.queued for stats in self.clients.values()),
+            "max_concurrent": self.max_concurrent,
+            "avg_service_seconds": round(self.avg_service_time, 3),
+            "clients": {
+                key: {
+                    "queued": stats.queued,
+                    "max_queued": stats.max_queued,
+                    "running": stats.running,
+                    "admitted": stats.admitted,
+                    "rejected": stats.rejected,
+                }
+                for key, stats in self.clients.items()
+            },
+        }
+
+
+scheduler = FairScheduler(MAX_CONCURRENT, MAX_QUEUED_PER_CLIENT)